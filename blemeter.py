@@ -0,0 +1,234 @@
+"""
+common code for the BLE meters, finds the device, connects to it, and passes each data packet to a device specific parser
+"""
+
+import asyncio
+import signal
+import time
+import traceback
+
+# requires Bleak, a Python library for BLE
+# https://bleak.readthedocs.io/en/latest/
+# https://github.com/hbldh/bleak
+from bleak import BleakScanner, BleakClient
+from bleak.exc import BleakError
+
+async def _retry(func, *args, attempts=3, delay=0.5):
+    # BLE stacks sometimes fail a request on a marginal link, try again with exponential backoff before giving up
+    for attempt in range(attempts):
+        try:
+            return await func(*args)
+        except (BleakError, asyncio.TimeoutError):
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(delay * (2 ** attempt))
+
+# one parsed data packet, these are reused by BLEMeter so copy the values out if you need to keep them
+class Sample:
+    __slots__ = ("t", "v", "a", "mah", "wh") # arrival time from time.time(), voltage, amperage, milliamphour, watthour
+
+# the common BLE handling for all the meters, see the device specific classes for how it's used
+class BLEMeter:
+    _FRAME_LEN = 36 # length of a data packet, anything else is not parsed
+    _QUEUE_LEN = 64 # how many parsed packets can wait for the callback before new ones are dropped
+    # the default UUIDs were found using a BLE scanning utility, both meters use the same ones
+    DATA_CHAR_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
+    DATA_SVC_UUID  = "0000ffe0-0000-1000-8000-00805f9b34fb"
+
+    # parser is a function that takes a 36 byte packet and a Sample, and fills in the sample
+    # use the callback parameter to register a callback function, useful for logging and such, it is called with a Sample from a worker thread
+    def __init__(self, parser, dev_name, dev_mac_addr=None, data_char_uuid=DATA_CHAR_UUID, callback=None, data_svc_uuid=DATA_SVC_UUID):
+        self._parse = parser
+        self.dev_name = dev_name
+        self.data_char_uuid = data_char_uuid
+        self._data_char_uuid_lc = data_char_uuid.lower()
+        self.data_svc_uuid = data_svc_uuid # the service that contains the data characteristic
+        self.dev_mac_addr = dev_mac_addr # optional, should be a string like "27:4B:B0:47:69:84"
+        self.callback = callback
+        self.device = None
+        self.client = None
+        self._scanner = None
+        self._found = None # created in find_device, on Python < 3.10 it binds to the event loop that's current when it's made
+        self._q = None # parsed packets waiting for the callback, a new one is made in connect since a queue is tied to the event loop it's first used on
+        # one more sample than the queue can hold, so a sample is never overwritten while it's still queued or being handled
+        self._samples = [Sample() for i in range(self._QUEUE_LEN + 1)]
+        self._sample_idx = 0
+        self._consumer = None
+        self.bad_frames = 0 # count of packets dropped for having the wrong length
+        self.dropped_frames = 0 # count of packets dropped because the callback fell too far behind
+
+    def _on_adv(self, d, ad):
+        if self._found is None or self._found.is_set():
+            return
+        if self.dev_mac_addr is not None: # user is allowed to specify a MAC address manually
+            if d.address.lower() != self.dev_mac_addr.lower():
+                return
+        elif d.name != self.dev_name: # name match comparison is the only way to automatically find the USB meter
+            return
+        self.device = d
+        self._found.set()
+
+    async def find_device(self, timeout=5.0):
+        # the scanner is kept between calls so retries don't have to set up a new one every time
+        # it is stopped as soon as the device advertises, instead of waiting for a full discovery sweep
+        if self._scanner is None:
+            self._scanner = BleakScanner(detection_callback=self._on_adv)
+        self._found = asyncio.Event()
+        await self._scanner.start()
+        try:
+            await asyncio.wait_for(self._found.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            await self._scanner.stop()
+        return self.device
+
+    async def connect(self, keep_trying=True):
+        # look for the device
+        while self.device is None:
+            await self.find_device()
+            if self.device is not None:
+                print("device \"%s\" found, MAC-addr: %s" % (self.device.name, self.device.address))
+                break
+            else:
+                print("device not found", end="")
+                if keep_trying:
+                    print(", retrying...")
+                else:
+                    return False
+        # device found
+        # only resolve the one service we need, the stack can skip enumerating everything else on the device
+        self.client = BleakClient(self.device.address, services=[self.data_svc_uuid])
+        try:
+            res = await _retry(self.client.connect)
+        except (BleakError, asyncio.TimeoutError) as e:
+            print("connection failed: %s" % e)
+            return False
+        if res: # if connection successful
+            # the MTU is negotiated by the OS while connecting, this is only here to get the real value for the message below
+            # on BlueZ, mtu_size is just a default of 23 until bleak's private _acquire_mtu() has looked it up
+            # that briefly acquires a characteristic for writing or for notifications, which is fine since notifications aren't started yet
+            acquire_mtu = getattr(self.client._backend, "_acquire_mtu", None)
+            if acquire_mtu is not None:
+                try:
+                    await acquire_mtu()
+                except Exception:
+                    pass # best effort, it only affects the printed value, so no failure here should stop the connection
+            print("connected, MTU: %d" % self.client.mtu_size)
+            if self._consumer is not None: # connect() called again without a disconnect() in between
+                self._consumer.cancel()
+                self._consumer = None
+            self._q = asyncio.Queue(maxsize=self._QUEUE_LEN)
+            # register the notification callback function
+            try:
+                await _retry(self.client.start_notify, self._data_char_uuid_lc, self.handle_data)
+            except (BleakError, asyncio.TimeoutError) as e:
+                print("failed to start notifications: %s" % e)
+                try:
+                    await self.client.disconnect()
+                except (BleakError, asyncio.TimeoutError):
+                    pass # the link is already in a bad state, it's being given up on anyways
+                self._q = None
+                return False
+            print("notifications started")
+            self._consumer = asyncio.create_task(self._consume())
+            # note: expect a notification once per second
+            return True
+        else:
+            return False
+
+    async def disconnect(self):
+        # stops the notifications and closes the BLE link, errors are ignored since the link might already be gone
+        if self._consumer is not None:
+            self._consumer.cancel()
+            self._consumer = None
+        self._q = None # anything still queued belongs to this connection, don't deliver it after a reconnect
+        if self.client is None:
+            return
+        try:
+            await self.client.stop_notify(self._data_char_uuid_lc)
+        except (BleakError, asyncio.TimeoutError):
+            pass
+        try:
+            await self.client.disconnect()
+        except (BleakError, asyncio.TimeoutError):
+            pass
+        print("disconnected")
+
+    async def handle_data(self, sender: int, data: bytearray):
+        if self.callback is None:
+            # if no function to call, then just print the raw data in hex format
+            print("data: %s" % data.hex(" ").upper())
+            return
+        if len(data) != self._FRAME_LEN:
+            # a firmware bug on the meter, I think it's sending AT commands but it's showing up here as ASCII bytes
+            self.bad_frames += 1
+            return
+        q = self._q
+        if q is None or q.full():
+            # the callback is too far behind, drop this packet rather than stall the notifications
+            # (or it arrived after disconnect() already threw the queue away)
+            self.dropped_frames += 1
+            return
+        # parse the packet into human readable format
+        sample = self._samples[self._sample_idx]
+        self._sample_idx = (self._sample_idx + 1) % len(self._samples)
+        sample.t = time.time() # taken here and not in the callback, which might run a while later if the queue backs up
+        self._parse(data, sample)
+        q.put_nowait(sample)
+
+    async def _consume(self):
+        # the callback is run in a worker thread, so slow logging doesn't block the event loop that delivers the notifications
+        # samples are handed over one at a time, the next one isn't taken off the queue until the callback returns
+        loop = asyncio.get_running_loop()
+        q = self._q # keep using the queue this task was started with, even if connect() makes a new one
+        while True:
+            sample = await q.get()
+            try:
+                await loop.run_in_executor(None, self.callback, sample)
+            except Exception:
+                # only this packet is lost, keep going so one bad callback doesn't stop all the data
+                print("error in data callback:")
+                traceback.print_exc()
+
+_ts_cache = (None, "") # the last whole second seen by timestamp() and its formatted time, so strftime only runs once per second
+# it's replaced as one tuple, callbacks run on worker threads and must never see a new second with the old string
+
+def timestamp(t=None):
+    # the time t (from time.time(), or now if not given) formatted like "%H:%M:%S.%f"
+    global _ts_cache
+    if t is None:
+        t = time.time()
+    sec = int(t)
+    cache = _ts_cache
+    if sec != cache[0]:
+        cache = (sec, time.strftime("%H:%M:%S", time.localtime(sec)))
+        _ts_cache = cache
+    return "%s.%06d" % (cache[1], int((t - sec) * 1000000))
+
+async def wait_for_interrupt():
+    # waits until Ctrl+C is pressed, without waking up the event loop in the meantime
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+    except NotImplementedError:
+        # no signal handlers on Windows, Ctrl+C will raise KeyboardInterrupt out of asyncio.run() instead
+        await stop.wait()
+        return
+    try:
+        await stop.wait()
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+
+def run(coro):
+    # like asyncio.run(), but uses uvloop if it's installed, it's a faster event loop
+    # https://github.com/MagicStack/uvloop
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(coro)
+    uvloop_run = getattr(uvloop, "run", None) # only in uvloop 0.18 and newer
+    if uvloop_run is None:
+        return asyncio.run(coro)
+    return uvloop_run(coro)